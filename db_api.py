@@ -1,8 +1,8 @@
 import time
 from cfg import cfg
-from typing import Any, List, Optional
+from typing import Any, Iterable, List, Optional, Set
 
-from models import db, MintTask
+from models import db, KeyValue, MintTask
 
 
 class DatabaseApi:
@@ -58,6 +58,15 @@ class DatabaseApi:
         task = await MintTask.query.where(MintTask.parent_id == parent_id).gino.one_or_none()
         return task
 
+    async def get_existing_parent_ids(self, parent_ids: Iterable[str]) -> Set[str]:
+        parent_ids = list(parent_ids)
+        if len(parent_ids) == 0:
+            return set()
+        rows = await self._database.select([MintTask.parent_id]).where(
+            MintTask.parent_id.in_(parent_ids)
+        ).gino.all()
+        return {row[0] for row in rows}
+
     async def create_mint_task(self, parent_id: str, to_puzzle_hash: str):
         mint_id = await self.get_mint_id()
         mint = await MintTask.create(
@@ -74,3 +83,16 @@ class DatabaseApi:
         ordering = MintTask.mint_id.asc()
         tasks = await MintTask.query.order_by(ordering).where(MintTask.status == 0).gino.all()
         return tasks
+
+    async def get_last_scanned_height(self) -> int:
+        row = await KeyValue.get("last_scanned_height")
+        if row is None:
+            return 0
+        return int(row.value)
+
+    async def set_last_scanned_height(self, height: int):
+        row = await KeyValue.get("last_scanned_height")
+        if row is None:
+            await KeyValue.create(key="last_scanned_height", value=str(height))
+        else:
+            await row.update(value=str(height)).apply()
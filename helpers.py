@@ -1,3 +1,4 @@
+import io
 import os.path as op
 import hashlib
 from cfg import cfg
@@ -30,3 +31,28 @@ def sha256sum(filename):
             h.update(chunk)
 
     return h.hexdigest()
+
+
+# Read-only file wrapper that feeds every chunk read into a sha256 hash
+class HashingReader(io.IOBase):
+    def __init__(self, file):
+        self.file = file
+        self.h = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        self.h.update(chunk)
+        return chunk
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+    def hexdigest(self):
+        return self.h.hexdigest()
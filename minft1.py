@@ -1,12 +1,16 @@
+import os
 import signal
+import sys
 import traceback
 from pathlib import Path
-from typing import List, Optional
-import nft_storage
+from typing import Any, Dict, List, Optional, Tuple
 import asyncio
 import logging
+import logging.handlers
+import queue
+
+import aiohttp
 
-from nft_storage.api import nft_storage_api
 from chia.rpc.full_node_rpc_client import FullNodeRpcClient
 from chia.rpc.wallet_rpc_client import WalletRpcClient
 from chia.types.coin_record import CoinRecord
@@ -17,141 +21,229 @@ from chia.util.ints import uint16
 
 from cfg import cfg
 from db_api import DatabaseApi
-from helpers import get_metadata_path, get_image_path, sha256sum
+from models import MintTask
+from helpers import get_metadata_path, get_image_path, HashingReader
 
 # Initialize logging
 log = logging.getLogger(__name__)
 
+# Seconds between deposit scans
+MIN_POLL_DELAY = 5.0
+MAX_POLL_DELAY = 60.0
+
+# Blocks below the last scanned height that are scanned again, so coins moved by a reorg are not missed
+SCAN_REORG_MARGIN = 32
+
+NFT_STORAGE_UPLOAD_URL = "https://api.nft.storage/upload"
+# No limit on the whole upload, multi-MB images on a slow link can take long, only on stalled sockets
+NFT_STORAGE_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+
+# Seconds between balance checks while a mint waits for the last spend to confirm
+BALANCE_POLL_DELAY = 10.0
+
+# Mint tasks waiting for the payout task before the monitor stops scanning
+MINT_QUEUE_SIZE = 16
+
+# Failed attempts per full node RPC call before the client is recreated
+RPC_RETRIES = 5
+
 
 class WalletServer:
+    config: Dict[str, Any]
     shut_down: bool
     shut_down_event: asyncio.Event
+    mint_queue: "asyncio.Queue[MintTask]"
     full_node_rpc: FullNodeRpcClient
+    full_node_reconnect_lock: asyncio.Lock
     wallet_client: WalletRpcClient
     receive_address: str
+    receive_address_bytes: bytes
+    last_scanned_height: int
+    poll_delay: float
     database_api: DatabaseApi
+    http: aiohttp.ClientSession
+    monitor_loop: "asyncio.Task[None]"
+    payout_loop: "asyncio.Task[None]"
 
     @staticmethod
     async def create_web_server():
         self = WalletServer()
         self.shut_down = False
         self.shut_down_event = asyncio.Event()
-        config = load_config(DEFAULT_ROOT_PATH, "config.yaml")
-        self_hostname = config["self_hostname"]
-        wallet_rpc_port = config["wallet"]["rpc_port"]
-        fullnode_rpc_port = config["full_node"]["rpc_port"]
+        # Mint tasks handed from the monitor to the payout task, the database stays the source of truth
+        self.mint_queue = asyncio.Queue(maxsize=MINT_QUEUE_SIZE)
+        self.config = load_config(DEFAULT_ROOT_PATH, "config.yaml")
+        wallet_rpc_port = self.config["wallet"]["rpc_port"]
 
-        self.wallet_client = await WalletRpcClient.create("127.0.0.1", uint16(wallet_rpc_port), DEFAULT_ROOT_PATH, config)
-        self.receive_address = cfg.wallet.receive_address
-        self.full_node_rpc = await FullNodeRpcClient.create(
-            self_hostname, fullnode_rpc_port, DEFAULT_ROOT_PATH, config
+        self.wallet_client = await WalletRpcClient.create(
+            "127.0.0.1", uint16(wallet_rpc_port), DEFAULT_ROOT_PATH, self.config
         )
+        self.receive_address = cfg.wallet.receive_address
+        self.receive_address_bytes = decode_puzzle_hash(self.receive_address)
+        self.full_node_rpc = await self.create_full_node_rpc()
+        self.full_node_reconnect_lock = asyncio.Lock()
         self.database_api = await DatabaseApi.create_api()
-        asyncio.create_task(self.monitor_deposit_task())
-        asyncio.create_task(self.payout_task())
+
+        # Keep one session around so the HTTPS connection pool is reused between mints
+        self.http = aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {cfg.key.nft_storage_api}"},
+            timeout=NFT_STORAGE_TIMEOUT
+        )
+
+        # Keep references so the loops aren't garbage collected, and shut down if one of them dies
+        self.monitor_loop = asyncio.create_task(self.monitor_deposit_task())
+        self.monitor_loop.add_done_callback(self.on_loop_done)
+        self.payout_loop = asyncio.create_task(self.payout_task())
+        self.payout_loop.add_done_callback(self.on_loop_done)
 
         asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.stop_all)
         asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop_all)
         return self
 
     async def monitor_deposit_task(self):
-        print("\U0001F916 Starting MinFT1 monitoring loop ==========================================")
+        log.info("\U0001F916 Starting MinFT1 monitoring loop ==========================================")
+        # Queue the tasks left pending from a previous run first
+        for task in await self.database_api.get_pending_tasks():
+            await self.mint_queue.put(task)
+
+        self.last_scanned_height = await self.database_api.get_last_scanned_height()
+        self.poll_delay = MIN_POLL_DELAY
         while True:
-            address_bytes = decode_puzzle_hash(self.receive_address)
+            # Read the peak before scanning so coins confirmed during the scan are picked up next time
+            blockchain_state = await self.full_node_call("get_blockchain_state")
+            peak = blockchain_state["peak"]
+            start_height = max(0, self.last_scanned_height - SCAN_REORG_MARGIN)
             coin_records: List[
                 CoinRecord
-            ] = await self.full_node_rpc.get_coin_records_by_puzzle_hash(
-                address_bytes, False
+            ] = await self.full_node_call(
+                "get_coin_records_by_puzzle_hash",
+                self.receive_address_bytes, False, start_height=start_height
             )
-            print(f"\U00002139 Receive address has {len(coin_records)} coin(s).")
+            log.info("\U00002139 Receive address has %d coin(s) since height %d.", len(coin_records), start_height)
 
-            for coin_record in coin_records:
-
-                # Fetch parent spend
-                parent_coin_name = coin_record.coin.parent_coin_info
-                parent_coin: Optional[
-                    CoinRecord
-                ] = await self.full_node_rpc.get_coin_record_by_name(
-                    parent_coin_name
+            # Fetch parent spends
+            parent_coins: List[Optional[CoinRecord]] = await asyncio.gather(
+                *(
+                    self.full_node_call("get_coin_record_by_name", coin_record.coin.parent_coin_info)
+                    for coin_record in coin_records
                 )
+            )
+            parent_ids = [parent_coin.coin.name().hex() for parent_coin in parent_coins]
+            existing_parent_ids = await self.database_api.get_existing_parent_ids(parent_ids)
+            found_new_deposit = False
 
+            for coin_record, parent_coin, parent_id in zip(coin_records, parent_coins, parent_ids):
                 received_amount = coin_record.coin.amount
                 to_puzzle_hash = parent_coin.coin.puzzle_hash
                 to_address = encode_puzzle_hash(to_puzzle_hash, "xch")
 
-                parent_id = parent_coin.coin.name()
-                task = await self.database_api.get_mint_task(parent_id.hex())
-                if task is not None:
-                    # print(f"\U00002716 Task for mint {task.mint_id} already exists.")
+                if parent_id in existing_parent_ids:
+                    # log.info("\U00002716 Task for parent %s already exists.", parent_id)
                     continue
 
                 if received_amount < cfg.wallet.price_xch:
-                    print(f"\U00002716 Not enough XCH received: {received_amount}")
+                    log.info("\U00002716 Not enough XCH received: %d", received_amount)
                     continue
 
-                print(f"\U0001f4B0 Received amount: {received_amount}")
-                print(f"  Parent_id: {parent_id.hex()}")
-                print(f"  Mint for: {to_puzzle_hash.hex()}")
-
-                await self.database_api.create_mint_task(parent_id=parent_id.hex(), to_puzzle_hash=to_address)
-                print("\U00002705 Creating new mint task")
+                log.info("\U0001f4B0 Received amount: %d", received_amount)
+                log.info("  Parent_id: %s", parent_id)
+                log.info("  Mint for: %s", to_puzzle_hash)
+
+                task = await self.database_api.create_mint_task(parent_id=parent_id, to_puzzle_hash=to_address)
+                # A parent spend can create several coins at the receive address, only mint once for it
+                existing_parent_ids.add(parent_id)
+                found_new_deposit = True
+                log.info("\U00002705 Creating new mint task")
+                # Blocks the scan while the queue is full
+                await self.mint_queue.put(task)
                 pass
 
-            await asyncio.sleep(30)
-
-    # mint
-    async def mint(self, image_path: str, to_address: str, mint_id: int):
-        sha = sha256sum(image_path)
-
-        configuration = nft_storage.Configuration(
-            host="https://api.nft.storage",
-            access_token=cfg.key.nft_storage_api
-        )
+            # The rescanned margin overlaps the last scan, the existing task check skips those coins
+            if peak is not None and peak.height > self.last_scanned_height:
+                self.last_scanned_height = peak.height
+                await self.database_api.set_last_scanned_height(self.last_scanned_height)
 
-        # Store image
+            # Back off while no new deposits arrive, poll quickly again once they do
+            if found_new_deposit:
+                self.poll_delay = MIN_POLL_DELAY
+            else:
+                self.poll_delay = min(self.poll_delay * 2, MAX_POLL_DELAY)
 
-        image_cid = None
+            if await self.wait_for_shut_down(self.poll_delay):
+                break
 
-        with nft_storage.ApiClient(configuration) as api_client:
-            # Create an instance of the API class
-            api_instance = nft_storage_api.NFTStorageAPI(api_client)
-            body = open(image_path, 'rb')  # file_type |
+    async def create_full_node_rpc(self) -> FullNodeRpcClient:
+        return await FullNodeRpcClient.create(
+            self.config["self_hostname"], uint16(self.config["full_node"]["rpc_port"]), DEFAULT_ROOT_PATH, self.config
+        )
 
+    # Call a full node RPC method, retrying on connection errors and reconnecting while they persist
+    async def full_node_call(self, method: str, *args, **kwargs):
+        attempt = 0
+        while True:
+            # Don't pick up a client that is being replaced
+            async with self.full_node_reconnect_lock:
+                client = self.full_node_rpc
             try:
-                api_response = api_instance.store(body, _check_return_type=False)
-                image_cid = api_response["value"]["cid"]
-                print(api_response)
-            except nft_storage.ApiException as e:
-                print("Exception when calling NFTStorageAPI->check: %s\n" % e)
-
-        assert image_cid is not None
+                return await getattr(client, method)(*args, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.warning("\U00002716 Full node RPC %s failed: %r", method, e)
 
-        image_url = f"https://{image_cid}.ipfs.nftstorage.link/"
+            attempt += 1
+            if attempt < RPC_RETRIES:
+                await asyncio.sleep(2 ** (attempt - 1))
+            else:
+                await self.reconnect_full_node(client)
+                attempt = 0
+
+    # Replace a failing full node client, the new one is in place before the old one is closed
+    async def reconnect_full_node(self, client: FullNodeRpcClient):
+        async with self.full_node_reconnect_lock:
+            # Concurrent calls may have reconnected already
+            if self.full_node_rpc is not client:
+                return
+            log.warning("\U00002139 Reconnecting to the full node")
+            self.full_node_rpc = await self.create_full_node_rpc()
+            client.close()
+            await client.await_closed()
+
+    # Upload a file to nft.storage, returns its CID and sha256
+    async def store_file(self, path: str) -> Tuple[Optional[str], str]:
+        cid = None
+
+        # aiohttp streams the file in chunks read in an executor, hashing them on the way
+        with HashingReader(open(path, 'rb')) as body:
+            headers = {"Content-Length": str(os.fstat(body.fileno()).st_size)}
+            async with self.http.post(NFT_STORAGE_UPLOAD_URL, data=body, headers=headers) as response:
+                if response.ok:
+                    api_response = await response.json()
+                    cid = api_response["value"]["cid"]
+                    log.info("Uploaded %s to nft.storage: %s", path, api_response)
+                else:
+                    log.error("Upload to nft.storage failed: %s", await response.text())
+
+        return cid, body.hexdigest()
 
-        # Store metadata
-        metadata_cid = None
+    # mint
+    async def mint(self, image_path: str, to_address: str, mint_id: int):
+        # Store image and metadata, the uploads don't depend on each other.
+        # Both hashes are computed while uploading, so each file is only read once.
         metadata_json_path = get_metadata_path(mint_id)
+        (image_cid, sha), (metadata_cid, metadata_sha) = await asyncio.gather(
+            self.store_file(image_path),
+            self.store_file(metadata_json_path),
+        )
 
-        with nft_storage.ApiClient(configuration) as api_client:
-            # Create an instance of the API class
-            api_instance = nft_storage_api.NFTStorageAPI(api_client)
-            body = open(metadata_json_path, 'rb')  # file_type |
-
-            try:
-                api_response = api_instance.store(body, _check_return_type=False)
-                metadata_cid = api_response["value"]["cid"]
-                print(api_response)
-            except nft_storage.ApiException as e:
-                print("Exception when calling NFTStorageAPI->check: %s\n" % e)
-
+        assert image_cid is not None
         assert metadata_cid is not None
 
+        image_url = f"https://{image_cid}.ipfs.nftstorage.link/"
         metadata_url = f"https://{metadata_cid}.ipfs.nftstorage.link/"
-        metadata_sha = sha256sum(metadata_json_path)
 
         # json_path.unlink()
-        print("\U000026A0 Starting minting process!")
-        print({
+        log.info("\U000026A0 Starting minting process!")
+        # Build the arguments once so the log shows exactly what is sent to the wallet
+        mint_kwargs = {
             'wallet_id': cfg.wallet.nft_wallet_id,
             'royalty_address': cfg.wallet.royalties_address,
             'target_address': to_address,
@@ -164,83 +256,115 @@ class WalletServer:
             'license_uris': [cfg.collection.license_url],
             'royalty_percentage': cfg.wallet.royalties_percent,
             'did_id': cfg.wallet.did
-        })
-        await self.wallet_client.mint_nft(
-            wallet_id=cfg.wallet.nft_wallet_id,
-            royalty_address=cfg.wallet.royalties_address,
-            target_address=to_address,
-            hash=sha,
-            uris=[image_url],
-            fee=cfg.wallet.minting_fees,
-            meta_hash=metadata_sha,
-            meta_uris=[metadata_url],
-            license_hash=cfg.collection.license_hash,
-            license_uris=[cfg.collection.license_url],
-            royalty_percentage=cfg.wallet.royalties_percent,
-            did_id=cfg.wallet.did
-        )
+        }
+        log.info("Minting %r", mint_kwargs)
+        await self.wallet_client.mint_nft(**mint_kwargs)
 
     # chia wallet nft mint -f 518133150 -i 39 -ra xch16dnl4tzef59ahmum8cm65es8kxslpgacey2prxdwh44ha6dj6lnsazm4ne -ta xch1qnpxe232hr40hl0kgw5n6tqsldyy68tdlc7zfxx88aw3uz026wlsjk9xs2 -mu https://bafkreibnqu7h4dkzuuhyptneo3fhw2trretgfpuscf4dc6uwgnxy556e54.ipfs.nftstorage.link -mh 2d853e7e0d59a50f87cda476ca7b6a71892662be921178317a96336f8ef7c4ef -u https://bafybeicn4prwjotrze6ofzrk3ssat4avqlgjf6wp5rsaudgdysvtzr55ie.ipfs.nftstorage.link -nh 1952b61f21f5cb2b91beaeb01fd53f1baefeed76b1e88beb73ff56a9b93b25fc -lu https://bafkreicvmmvbnri62bde6qkuicrlloauavgehdvtmo5j5t3xhhu5dheije.ipfs.nftstorage.link -lh 55632a16c51ed0464f415440a2b5b814054c438eb363ba9ecf7739e9d19c8849 -rp 500 -m 0.00001
     async def payout_task(self):
         while True:
-            await asyncio.sleep(10)
-            standard = await self.wallet_client.get_wallet_balance(1)
-            standard_balance = standard["spendable_balance"]
-            standard_total = standard["confirmed_wallet_balance"]
-
-            mint = False
-            if standard_balance > 0 and standard_balance == standard_total:
-                mint = True
+            task = await self.next_mint_task()
+            if task is None:
+                break
 
-            if mint is False:
-                continue
+            log.info("\U00002139 %d more tasks in queue.", self.mint_queue.qsize())
 
-            # Get pending mints
-            tasks = await self.database_api.get_pending_tasks()
+            # Every mint spends from the wallet, wait until the balance is confirmed again
+            # instead of dropping the backlog until the next wake-up
+            while not await self.can_mint():
+                if await self.wait_for_shut_down(BALANCE_POLL_DELAY):
+                    return
 
-            if len(tasks) == 0:
-                # print(f"There are {len(tasks)} tasks")
-                continue
-
-            print(f"\U00002139 {len(tasks)} tasks in queue.")
-
-            tasks = await self.database_api.get_pending_tasks()
-            task = tasks[0]
-
-            if task.mint_image_url is not None and task.mint_image_url != "":
-                image_path = task.mint_image_url
-            else:
-                image_path = get_image_path(task.mint_id)
-
-            assert Path(image_path).is_file()
-            assert len(Path(image_path).read_bytes()) > 10000
-
-            # new_path = Path(f"{Path(image_path).parent}/{task.mint_id}.png")
-            # new_path.write_bytes(Path(image_path).read_bytes())
-
-            new_path_str = f"{Path(image_path).absolute()}"
-            if task.mint_id+1 >= cfg.collection.size:
-                print(f"\U00002139 This collection is fully minted. Minting is disabled. ")
-                await asyncio.sleep(30000)
-                continue
-
-            print(f"\U00002705 Time to mint {task}")
+            # A failing task is logged and skipped so the queue keeps draining
+            try:
+                if task.mint_image_url is not None and task.mint_image_url != "":
+                    image_path = task.mint_image_url
+                else:
+                    image_path = get_image_path(task.mint_id)
+                image_file = Path(image_path)
+
+                try:
+                    image_size = image_file.stat().st_size
+                except FileNotFoundError:
+                    image_size = 0
+                assert image_size > 10000
+
+                # new_path = Path(f"{Path(image_path).parent}/{task.mint_id}.png")
+                # new_path.write_bytes(Path(image_path).read_bytes())
+
+                new_path_str = f"{image_file.absolute()}"
+                if task.mint_id+1 >= cfg.collection.size:
+                    log.info("\U00002139 This collection is fully minted. Minting is disabled.")
+                    if await self.wait_for_shut_down(30000):
+                        break
+                    continue
 
-            await task.update(status=1).apply()
-            await self.mint(to_address=task.to_address, mint_id=task.mint_id, image_path=new_path_str)
+                log.info("\U00002705 Time to mint %s", task)
+
+                await task.update(status=1).apply()
+                await self.mint(to_address=task.to_address, mint_id=task.mint_id, image_path=new_path_str)
+            except Exception:
+                log.exception("\U00002716 Mint task %d failed", task.mint_id)
+
+    # Wait for the next queued mint task, returns None if the server is shutting down
+    async def next_mint_task(self) -> Optional[MintTask]:
+        get_task = asyncio.create_task(self.mint_queue.get())
+        shut_down_task = asyncio.create_task(self.shut_down_event.wait())
+        await asyncio.wait({get_task, shut_down_task}, return_when=asyncio.FIRST_COMPLETED)
+        shut_down_task.cancel()
+        if get_task.done():
+            return get_task.result()
+        get_task.cancel()
+        return None
+
+    # The wallet can mint once it has a balance and no unconfirmed spends
+    async def can_mint(self) -> bool:
+        standard = await self.wallet_client.get_wallet_balance(1)
+        standard_balance = standard["spendable_balance"]
+        standard_total = standard["confirmed_wallet_balance"]
+
+        return standard_balance > 0 and standard_balance == standard_total
+
+    # Sleep for up to timeout seconds, returns True if the server is shutting down
+    async def wait_for_shut_down(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.shut_down_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def on_loop_done(self, loop_task: asyncio.Task):
+        if loop_task.cancelled() or loop_task.exception() is None:
+            return
+        log.error("\U00002716 %s crashed, shutting down", loop_task.get_coro().__qualname__, exc_info=loop_task.exception())
+        self.stop_all()
 
     def stop_all(self):
         self.shut_down = True
         self.shut_down_event.set()
 
+    async def close(self):
+        # Let a mint in progress finish its uploads before the session goes away
+        await asyncio.wait({self.payout_loop})
+        await self.http.close()
+
 
 async def run_wallet_server():
     server: WalletServer = await WalletServer.create_web_server()
     await server.shut_down_event.wait()
+    await server.close()
 
 
 def main():
-    asyncio.run(run_wallet_server())
+    # Log to stdout like the old prints, through a queue so the event loop thread never blocks on the write
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)], force=True)
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    log_listener.start()
+    try:
+        asyncio.run(run_wallet_server())
+    finally:
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -27,6 +27,13 @@ class MintTask(db.Model):  # type: ignore # noqa
         return str(self.__class__) + ": " + str(self.__dict__)
 
 
+class KeyValue(db.Model):  # type: ignore # noqa
+    __tablename__ = "kv"
+
+    key = db.Column(db.Text(), primary_key=True)
+    value = db.Column(db.Text(), nullable=False)
+
+
 db.Index("index_MintTask_valid_from", MintTask.valid_from)
 db.Index("index_MintTask_valid_to", MintTask.valid_to)
 db.Index("index_MintTask_address", MintTask.to_address)